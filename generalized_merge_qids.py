@@ -8,21 +8,41 @@ No harmonized columns required. If `_feature_id` and `_coords_json` exist,
 they are used for optional [EXT:...] disambiguation; otherwise skipped cleanly.
 """
 
-import os, time, json, re, argparse, hashlib
-from typing import Dict, Any, List, Optional
+import os, time, json, re, argparse, hashlib, sqlite3
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Set, Tuple
 from pathlib import Path
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry
 
 try:
     import yaml
 except Exception:
     yaml = None
 
+try:
+    import ijson  # optional: stream result bindings instead of parsing the whole response
+except Exception:
+    ijson = None
+
 SPARQL_URL = "https://query.wikidata.org/sparql"
 DEFAULT_USER_AGENT = "OET-wikidata-qid-generator/merge (mailto:info@openenergytransition.org)"
 DEFAULT_CODE_CANDIDATES = ["Codigo","codigo","id_circuito","Code","code","ID","id"]
+PID_RE = re.compile(r"^P\d+$")
+HTTP_TIMEOUT_S = 90          # client-side read timeout
+SERVER_TIMEOUT_MS = 60000    # WDQS 'timeout' parameter, so stalled queries are also stopped server-side
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# failures while reading a 200 body (WDQS cuts the stream on timeouts); urllib3's Retry never sees these
+BODY_ERRORS = (requests.exceptions.ChunkedEncodingError, ValueError)
+if ijson is not None:
+    # ijson reads r.raw directly, so a cut-off stream raises urllib3/ijson errors instead of requests'
+    BODY_ERRORS += (ProtocolError, ijson.JSONError)
 
 def sha1_token(fid: str, coords_json: str) -> str:
     basis = f"{fid}|{(coords_json or '')[:256]}"
@@ -35,50 +55,184 @@ def chunked(seq: List[str], n: int):
     for i in range(0, len(seq), n):
         yield seq[i:i+n]
 
-def http_post_sparql(query: str, user_agent: str, retries: int, backoff: float) -> Dict[str, Any]:
-    headers = {
+def backoff_delay(backoff: float, n: int) -> float:
+    """Sleep before the n-th retry: backoff**(n-1) + 0.1*n seconds (1.1/1.8/2.9/4.4 s for 1.6)."""
+    return backoff ** (n - 1) + 0.1 * n
+
+class ExpBackoffRetry(Retry):
+    """urllib3 Retry that keeps the script's original schedule, with `backoff_factor` as the exponential base."""
+    def get_backoff_time(self) -> float:
+        n = sum(1 for h in self.history if h.redirect_location is None)
+        return backoff_delay(self.backoff_factor, n) if n else 0.0
+
+def make_session(user_agent: str, retries: int, backoff: float, pool_size: int) -> requests.Session:
+    """
+    One keep-alive session for all batches; urllib3 retries 429/5xx (honouring Retry-After).
+    `retries` counts attempts in total and `backoff` is the exponential base, as in the config.
+    """
+    session = requests.Session()
+    session.headers.update({
         "Accept": "application/sparql-results+json",
         "User-Agent": user_agent or DEFAULT_USER_AGENT,
-    }
-    attempt = 0
-    while True:
-        attempt += 1
-        try:
-            r = requests.post(SPARQL_URL, data={"query": query}, headers=headers, timeout=90)
-            if r.status_code in (429, 500, 502, 503, 504):
-                raise requests.HTTPError(f"Retryable {r.status_code}")
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            if attempt >= retries:
-                raise
-            sleep_s = (backoff ** (attempt - 1)) + 0.1 * attempt
-            print(f"[retry {attempt}/{retries}] WDQS -> {e}. Sleep {sleep_s:.1f}s", flush=True)
-            time.sleep(sleep_s)
+    })
+    retry = ExpBackoffRetry(
+        total=max(retries - 1, 0),  # Retry counts re-sends, not attempts
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=None,  # WDQS queries are POSTs, which urllib3 does not retry by default
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+def http_post_sparql(session: requests.Session, query: str) -> Iterator[Dict[str, Any]]:
+    """Yield result bindings; with ijson they are parsed as they arrive instead of via r.json()."""
+    data = {"query": query, "timeout": str(SERVER_TIMEOUT_MS)}
+    if ijson is None:
+        r = session.post(SPARQL_URL, data=data, timeout=HTTP_TIMEOUT_S)
+        r.raise_for_status()
+        yield from r.json().get("results", {}).get("bindings", [])
+        return
+    with session.post(SPARQL_URL, data=data, timeout=HTTP_TIMEOUT_S, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True  # let urllib3 undo gzip before ijson sees the bytes
+        yield from ijson.items(r.raw, "results.bindings.item")
 
 def build_values_list(codes: List[str]) -> str:
     return " ".join(f'"{str(c).replace(chr(34), "")}"' for c in codes if isinstance(c, str) and str(c).strip())
 
+def result_limit(codes: List[str]) -> int:
+    """LIMIT of a batch query; a batch that returns this many rows may have been cut off."""
+    return max(len(codes) * 10, 500)
+
 def build_sparql_for_codes(props: List[str], codes: List[str], lang_desc: str) -> str:
     values = build_values_list(codes)
-    unions = []
-    for p in props:
-        p = p.strip()
-        if not re.match(r"^P\d+$", p):
-            continue
-        unions.append(f"?item wdt:{p} ?code .")
-    union_block = " UNION ".join("{" + u + "}" for u in unions) if unions else "{ ?item wdt:P528 ?code . }"
+    valid_props = [p.strip() for p in props if PID_RE.match(p.strip())] or ["P528"]
+    props_block = " ".join(f"wdt:{p}" for p in valid_props)
     return f"""
 SELECT ?item ?code ?desc WHERE {{
   VALUES ?code {{ {values} }}
-  {union_block}
+  VALUES ?p {{ {props_block} }}
+  ?item ?p ?code .
   OPTIONAL {{
     ?item schema:description ?desc .
     FILTER (LANG(?desc) = "{lang_desc}")
   }}
 }}
+LIMIT {result_limit(codes)}
 """
 
+def parse_bindings(bindings: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, str]]]:
+    hits: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+    for b in bindings:
+        code = b.get("code", {}).get("value", "")
+        item = b.get("item", {}).get("value", "")
+        if code and item:
+            hits[code].append({"qid": qid_from_uri(item), "desc": b.get("desc", {}).get("value", "")})
+    return dict(hits)
+
+def fetch_batch(session: requests.Session, batch: List[str], props: List[str], lang: str,
+                throttle: float, retries: int, backoff: float) -> Tuple[Dict[str, List[Dict[str, str]]], Set[str]]:
+    """
+    Run one batch query and return (hits per code, codes whose hits may be incomplete); each worker
+    keeps `throttle` s between its requests. A response body that breaks off or does not parse is
+    fetched again, up to `retries` attempts, and a batch that fills its LIMIT is re-queried in halves.
+    """
+    q = build_sparql_for_codes(props, batch, lang)
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.time()
+        try:
+            hits = parse_bindings(http_post_sparql(session, q))
+            break
+        except BODY_ERRORS as e:
+            if attempt >= retries:
+                raise
+            sleep_s = backoff_delay(backoff, attempt)
+            print(f"[retry {attempt}/{retries}] WDQS -> {e}. Sleep {sleep_s:.1f}s", flush=True)
+            time.sleep(sleep_s)
+    elapsed = time.time() - start
+    if elapsed < throttle:
+        time.sleep(throttle - elapsed)
+
+    limit = result_limit(batch)
+    if sum(len(h) for h in hits.values()) < limit:
+        return hits, set()
+    if len(batch) == 1:
+        print(f"[WARN] code {batch[0]!r} alone filled the LIMIT of {limit} results; its hits may be incomplete and are not cached")
+        return hits, set(batch)
+    print(f"[WARN] batch of {len(batch)} codes filled the LIMIT of {limit} results; re-querying it in halves")
+    mid = len(batch) // 2
+    hits, truncated = fetch_batch(session, batch[:mid], props, lang, throttle, retries, backoff)
+    more, more_truncated = fetch_batch(session, batch[mid:], props, lang, throttle, retries, backoff)
+    hits.update(more)
+    return hits, truncated | more_truncated
+
+def open_cache(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS hits("
+        "props TEXT, code TEXT, payload TEXT, ts INTEGER, PRIMARY KEY(props, code))"
+    )
+    return conn
+
+def cache_lookup(conn: sqlite3.Connection, props_key: str, codes: List[str],
+                 ttl_days: float) -> Dict[str, List[Dict[str, str]]]:
+    """Return cached hits for `codes`, ignoring entries older than `ttl_days` (0 = never expire)."""
+    min_ts = int(time.time() - ttl_days * 86400) if ttl_days else 0
+    found: Dict[str, List[Dict[str, str]]] = {}
+    for chunk in chunked(codes, 500):
+        marks = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT code, payload FROM hits WHERE props = ? AND ts >= ? AND code IN ({marks})",
+            [props_key, min_ts, *chunk],
+        )
+        for code, payload in rows:
+            found[code] = json.loads(payload)
+    return found
+
+def cache_store(conn: sqlite3.Connection, props_key: str, hits: Dict[str, List[Dict[str, str]]]) -> None:
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR REPLACE INTO hits(props, code, payload, ts) VALUES (?, ?, ?, ?)",
+        [(props_key, code, json.dumps(h, ensure_ascii=False), now) for code, h in hits.items()],
+    )
+    conn.commit()
+
+def resolve_qids(codes: pd.Series, ext_tokens: List[str],
+                 code_hits: Dict[str, List[Dict[str, str]]]) -> Tuple[List[str], int, int]:
+    """
+    Pick one QID per row by joining the rows against the hits table.
+    A code with a single hit (or a row without ext token) takes its first hit; otherwise the
+    row needs exactly one hit whose description carries its [EXT:token] tag, else it is ambiguous.
+    Returns (qids, unresolved, ambiguous).
+    """
+    rows = pd.DataFrame({
+        "code": codes.astype(object).map(str).str.strip().to_numpy(),
+        "token": ext_tokens,
+    })
+    hits_df = pd.DataFrame(
+        [(code, h["qid"], h["desc"]) for code, hs in code_hits.items() for h in hs],
+        columns=["code", "qid", "desc"],
+    )
+    by_code = hits_df.groupby("code")["qid"]
+    n_hits = rows["code"].map(by_code.size()).fillna(0)
+    first_qid = rows["code"].map(by_code.first())
+
+    chosen = pd.Series("", index=rows.index, dtype=object)
+    direct = (n_hits == 1) | ((n_hits > 1) & (rows["token"] == ""))
+    chosen[direct] = first_qid[direct]
+
+    need_ext = rows[(n_hits > 1) & (rows["token"] != "")]
+    cand = need_ext.rename_axis("row").reset_index().merge(hits_df, on="code")
+    cand["has_ext"] = [f"[EXT:{t}]" in d for t, d in zip(cand["token"], cand["desc"])]
+    tagged = cand[cand["has_ext"].astype(bool)].groupby("row")["qid"].agg(["size", "first"])
+    tagged = tagged[tagged["size"] == 1]
+    chosen[tagged.index] = tagged["first"]
+
+    return chosen.tolist(), int((n_hits == 0).sum()), len(need_ext) - len(tagged)
+
 def read_merge_cfg(cfg_path: Optional[str]) -> dict:
     defaults = {
         "wikidata_match_props": ["P528"],
@@ -86,9 +240,12 @@ def read_merge_cfg(cfg_path: Optional[str]) -> dict:
         "code_candidates": DEFAULT_CODE_CANDIDATES,
         "batch_size": 75,
         "throttle": 3.0,
+        "concurrency": 4,
         "retries": 5,
         "backoff": 1.6,
         "language": "es",
+        "cache_db": None,
+        "cache_ttl_days": 30,
     }
     if not cfg_path or not yaml:
         return defaults
@@ -140,10 +297,13 @@ def main():
     ap.add_argument("--props", nargs="+", help="Override identifier properties (e.g., P528 P712)")
     ap.add_argument("--lang", help="Description language (default from YAML or 'es')")
     ap.add_argument("--batch-size", type=int, help="Override batch size")
-    ap.add_argument("--throttle", type=float, help="Override throttle seconds between batches")
+    ap.add_argument("--throttle", type=float, help="Override throttle seconds between requests, per worker (not per run)")
+    ap.add_argument("--concurrency", type=int, help="Override number of batches queried in parallel")
     ap.add_argument("--retries", type=int, help="Override retries")
     ap.add_argument("--backoff", type=float, help="Override exponential backoff base")
     ap.add_argument("--user-agent", help="Override User-Agent header for WDQS")
+    ap.add_argument("--cache-db", help="SQLite file caching code->QID hits between runs")
+    ap.add_argument("--cache-ttl", type=float, help="Days before a cached hit is re-queried (0 = never)")
     args = ap.parse_args()
 
     df = pd.read_csv(args.input, dtype=str, encoding="utf-8", low_memory=False)
@@ -156,90 +316,64 @@ def main():
     lang = args.lang if args.lang else cfg["language"]
     batch_size = args.batch_size if args.batch_size else cfg["batch_size"]
     throttle = args.throttle if args.throttle else cfg["throttle"]
+    concurrency = args.concurrency if args.concurrency else cfg["concurrency"]
     retries = args.retries if args.retries else cfg["retries"]
     backoff = args.backoff if args.backoff else cfg["backoff"]
+    cache_db = args.cache_db if args.cache_db else cfg["cache_db"]
+    cache_ttl = args.cache_ttl if args.cache_ttl is not None else cfg["cache_ttl_days"]
 
     print(f"[INFO] Matching properties: {', '.join(match_props)}")
     print(f"[INFO] Code candidates: {', '.join(code_candidates)}")
     print(f"[INFO] Using UA: {ua}")
-    print(f"[INFO] lang={lang} batch={batch_size} throttle={throttle}s retries={retries} backoff={backoff}")
+    print(f"[INFO] lang={lang} batch={batch_size} throttle={throttle}s concurrency={concurrency} retries={retries} backoff={backoff}")
 
     code_col = select_code_column(df, args.code_col, code_candidates)
 
     have_feature = "_feature_id" in df.columns
     have_coords = "_coords_json" in df.columns
     if have_feature and have_coords:
-        ext_tokens = [
-            sha1_token(str(fid or ""), str(cj or ""))
-            for fid, cj in zip(df["_feature_id"].fillna(""), df["_coords_json"].fillna(""))
-        ]
+        fids = df["_feature_id"].fillna("").to_numpy()
+        coords = df["_coords_json"].fillna("").to_numpy()
+        ext_tokens = [sha1_token(str(fid or ""), str(cj or "")) for fid, cj in zip(fids, coords)]
     else:
         ext_tokens = [""] * len(df)
 
     codes = sorted({str(x).strip() for x in df[code_col].fillna("").astype(str) if str(x).strip()})
     print(f"[INFO] Unique codes to resolve: {len(codes)}")
 
-    def build_sparql_for_codes(props: List[str], codes: List[str], lang_desc: str) -> str:
-        values = " ".join(f'"{str(c).replace(chr(34), "")}"' for c in codes if isinstance(c, str) and str(c).strip())
-        unions = []
-        for p in props:
-            p = p.strip()
-            if not re.match(r"^P\d+$", p):
-                continue
-            unions.append(f"?item wdt:{p} ?code .")
-        union_block = " UNION ".join("{" + u + "}" for u in unions) if unions else "{ ?item wdt:P528 ?code . }"
-        return f"""
-SELECT ?item ?code ?desc WHERE {{
-  VALUES ?code {{ {values} }}
-  {union_block}
-  OPTIONAL {{
-    ?item schema:description ?desc .
-    FILTER (LANG(?desc) = "{lang_desc}")
-  }}
-}}
-"""
-
     code_hits: Dict[str, List[Dict[str, str]]] = {}
-    total = 0
-    for batch in (codes[i:i+batch_size] for i in range(0, len(codes), batch_size)):
-        q = build_sparql_for_codes(match_props, batch, lang)
-        start = time.time()
-        data = http_post_sparql(q, ua, retries, backoff)
-        for b in data.get("results", {}).get("bindings", []):
-            code = b.get("code", {}).get("value", "")
-            item = b.get("item", {}).get("value", "")
-            desc = b.get("desc", {}).get("value", "")
-            if code and item:
-                code_hits.setdefault(code, []).append({"qid": qid_from_uri(item), "desc": desc or ""})
-                total += 1
-        elapsed = time.time() - start
-        if elapsed < throttle:
-            time.sleep(throttle - elapsed)
-        print(f"[INFO] batch size={len(batch)} -> cumulative candidates={total}")
-
-    chosen: List[Optional[str]] = []
-    unresolved = ambiguous = 0
-    for i, row in df.iterrows():
-        code = str(row.get(code_col, "")).strip()
-        token = ext_tokens[i]
-        hits = code_hits.get(code, [])
-
-        if not hits:
-            chosen.append("")
-            unresolved += 1
-            continue
-
-        if len(hits) == 1 or not token:
-            chosen.append(hits[0]["qid"]); continue
-
-        tag = f"[EXT:{token}]"
-        with_ext = [h for h in hits if tag in h["desc"]]
-        if len(with_ext) == 1:
-            chosen.append(with_ext[0]["qid"])
-        else:
-            ambiguous += 1
-            chosen.append("")
+    cache = open_cache(cache_db) if cache_db else None
+    props_key = f"{','.join(sorted(match_props))}|{lang}"
+    if cache:
+        code_hits.update(cache_lookup(cache, props_key, codes, cache_ttl))
+        print(f"[INFO] Cache hits: {len(code_hits)} of {len(codes)} codes ({cache_db})")
+    pending = [c for c in codes if c not in code_hits]
+
+    total = sum(len(h) for h in code_hits.values())
+    batches = list(chunked(pending, batch_size))
+    workers = max(1, concurrency)
+    with make_session(ua, retries, backoff, workers) as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(fetch_batch, session, batch, match_props, lang, throttle, retries, backoff): batch
+            for batch in batches
+        }
+        try:
+            for fut in as_completed(futures):
+                batch = futures[fut]
+                batch_hits, truncated = fut.result()
+                code_hits.update(batch_hits)
+                total += sum(len(h) for h in batch_hits.values())
+                if cache:
+                    cache_store(cache, props_key, {c: h for c, h in batch_hits.items() if c not in truncated})
+                print(f"[INFO] batch size={len(batch)} -> cumulative candidates={total}")
+        except BaseException:
+            # abort on the first failed batch; otherwise leaving the `with` would still send every queued one
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    if cache:
+        cache.close()
 
+    chosen, unresolved, ambiguous = resolve_qids(df[code_col], ext_tokens, code_hits)
     df["wikidata"] = chosen
     print(f"[SUMMARY] rows={len(df)} | with_qid={df['wikidata'].astype(bool).sum()} | unresolved={unresolved} | ambiguous={ambiguous}")
 
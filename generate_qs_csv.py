@@ -6,12 +6,18 @@ QuickStatements CSV generator, country-aware via harmonize_config.yaml.
 Usage:
   python generate_qs_csv.py <input_harmonized.csv> [output_dir]
 """
-import os, sys, re, json, hashlib
-from decimal import Decimal, InvalidOperation
+import os, sys, re, json, csv, hashlib, itertools
+from decimal import Decimal
 from pathlib import Path
 import pandas as pd
 import yaml
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pv
+except Exception:
+    pa = pv = None
+
 # ---------------- CLI ----------------
 if len(sys.argv) < 2:
     print("Usage: python generate_qs_csv_updated.py <input_harmonized.csv> [output_dir]")
@@ -25,6 +31,13 @@ QS_OUT = os.path.join(OUTPUT_DIR, "qs_transmision_upload_no_p1114.csv")
 BASE_DIR = Path(__file__).parent
 CFG_PATH = BASE_DIR / "harmonize_config.yaml"
 
+# ---------------- Regex patterns (compiled once) ----------------
+DECIMAL_RE   = re.compile(r"([-+]?\d+(?:\.\d+)?)")
+ISODATE_RE   = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+MLS_HEAD_RE  = re.compile(r"MULTILINESTRING\s*\(\(", re.I)
+LS_HEAD_RE   = re.compile(r"LINESTRING\s*\(", re.I)
+SEG_SPLIT_RE = re.compile(r"\)\s*,\s*\(")
+
 # ---------------- YAML helpers ----------------
 def read_yaml(path: Path) -> dict:
     if not path.exists():
@@ -37,28 +50,35 @@ def as_time_str(s: str) -> str:
         return ""
     if isinstance(s, str) and s.startswith("+") and s.endswith("/11"):
         return s
-    if isinstance(s, str) and re.match(r"^\d{4}-\d{2}-\d{2}$", s):
+    if isinstance(s, str) and ISODATE_RE.match(s):
         return f"+{s}T00:00:00Z/11"
     return ""
 
-def find_input_block_for_csv(cfg: dict, input_csv_path: str):
-    inputs = (cfg or {}).get("inputs", []) or []
-    target = os.path.basename(input_csv_path)
-    for inp in inputs:
+def index_inputs(cfg: dict):
+    """Map each configured input's basename and absolute path to (position, block); first entry wins."""
+    by_name, by_path = {}, {}
+    for i, inp in enumerate((cfg or {}).get("inputs", []) or []):
         p = inp.get("path","")
-        if p and os.path.basename(p) == target:
-            return inp
-        if p and os.path.abspath(p) == os.path.abspath(input_csv_path):
-            return inp
+        if p:
+            by_name.setdefault(os.path.basename(p), (i, inp))
+            by_path.setdefault(os.path.abspath(p), (i, inp))
+    return by_name, by_path
+
+def find_input_block_for_csv(cfg: dict, input_csv_path: str, index=None):
+    by_name, by_path = index or index_inputs(cfg)
+    hits = [h for h in (by_name.get(os.path.basename(input_csv_path)),
+                        by_path.get(os.path.abspath(input_csv_path))) if h]
+    if hits:
+        return min(hits, key=lambda h: h[0])[1]
     stem = os.path.basename(input_csv_path).replace("_harmonized_for_qs.csv","")
-    for inp in inputs:
-        p = inp.get("path","")
-        if p and os.path.basename(p).startswith(stem):
+    for name, (_, inp) in sorted(by_name.items(), key=lambda kv: kv[1][0]):
+        if name.startswith(stem):
             return inp
     return {}
 
 CFG = read_yaml(CFG_PATH)
-INP_BLOCK = find_input_block_for_csv(CFG, INPUT_CSV)
+INPUT_INDEX = index_inputs(CFG)
+INP_BLOCK = find_input_block_for_csv(CFG, INPUT_CSV, INPUT_INDEX)
 COUNTRY_META = (INP_BLOCK.get("country") if INP_BLOCK else {}) or {}
 
 # ---------------- Constants (schema/units only) ----------------
@@ -76,6 +96,9 @@ S813_TIME   = as_time_str(COUNTRY_META.get("access_time","")) or ""
 if S854_URL:
     S854_URL = f'"{S854_URL}"'
 
+# Reference block (S248 stated in, s854 URL, s813 retrieved) repeated after every statement
+REF = (S248_QID, S854_URL, S813_TIME)
+
 # ---------------- Column names expected from harmonizer ----------------
 COL_QID     = "qid"
 COL_CODE    = "Codigo"
@@ -86,152 +109,181 @@ COL_FID     = "_feature_id"
 COL_COORDSJ = "_coords_json"
 
 # ---------------- Helpers (robust parsing, same output) ----------------
-def plain_decimal(v) -> str:
-    if v is None:
-        return ""
-    s = str(v).strip()
-    if not s:
-        return ""
-    s = s.replace(",", ".")
-    m = re.search(r"[-+]?\d+(?:\.\d+)?", s)
-    if not m:
-        return ""
-    try:
-        d = Decimal(m.group(0))
-        return format(d, "f")
-    except (InvalidOperation, ValueError):
-        return ""
+def column(df: pd.DataFrame, col: str) -> pd.Series:
+    """Return `df[col]`, or a column of empty strings when the input lacks it."""
+    if col in df.columns:
+        return df[col]
+    return pd.Series("", index=df.index, dtype=object)
 
-def volts_from_kv(vkv) -> str:
-    s = plain_decimal(vkv)
-    if not s:
-        return ""
-    try:
-        d = Decimal(s) * Decimal(1000)
-        return f"{format(d, 'f')}U{Q_VOLT[1:]}"
-    except Exception:
-        return ""
+def plain_decimal(values: pd.Series) -> pd.Series:
+    nums = values.str.replace(",", ".", regex=False).str.extract(DECIMAL_RE, expand=False)
+    return nums.map(lambda n: format(Decimal(n), "f"), na_action="ignore").fillna("")
+
+def volts_from_kv(values: pd.Series) -> pd.Series:
+    nums = plain_decimal(values)
+    return nums.map(lambda n: f"{format(Decimal(n) * Decimal(1000), 'f')}U{Q_VOLT[1:]}" if n else "")
 
 def ext_token(fid: str, coords_json: str) -> str:
     basis = f"{fid}|{(coords_json or '')[:256]}"
     return hashlib.sha1(basis.encode("utf-8", "ignore")).hexdigest()[:12]
 
-def coord_from_any(coords_in: str) -> str:
-    """
-    Return '@lat/lon' for QS P625.
-    Accepts JSON [[[lon,lat],...], ...], WKT MULTILINESTRING(...), or WKT LINESTRING(...).
-    """
-    if not coords_in:
+def mean_point(pts: list) -> str:
+    if not pts:
         return ""
-    s = coords_in.strip().strip("'").strip('"')
+    lon_mean = sum(p[0] for p in pts) / len(pts)
+    lat_mean = sum(p[1] for p in pts) / len(pts)
+    return f"@{lat_mean}/{lon_mean}"
 
-    # 1) JSON
+def json_centroid(s: str) -> str:
+    """'@lat/lon' of a JSON [[[lon,lat],...], ...] multiline, or '' if `s` is not one."""
     try:
         geom = json.loads(s)
-        pts = [(lon, lat) for line in geom for lon, lat in line]
-        if pts:
-            lon_mean = sum(p[0] for p in pts) / len(pts)
-            lat_mean = sum(p[1] for p in pts) / len(pts)
-            return f"@{lat_mean}/{lon_mean}"
-    except Exception:
-        pass
-
-    # 2) MULTILINESTRING
-    m = re.search(r"MULTILINESTRING\s*\(\((.*)\)\)", s, flags=re.I | re.S)
-    if m:
-        inner = m.group(1)
-        segs = re.split(r"\)\s*,\s*\(", inner)
-        pts = []
-        for seg in segs:
-            for pair in seg.split(","):
-                parts = pair.strip().split()
-                if len(parts) >= 2:
-                    try:
-                        lon = float(parts[0]); lat = float(parts[1])
-                        pts.append((lon, lat))
-                    except Exception:
-                        continue
-        if pts:
-            lon_mean = sum(p[0] for p in pts) / len(pts)
-            lat_mean = sum(p[1] for p in pts) / len(pts)
-            return f"@{lat_mean}/{lon_mean}"
-
-    # 3) LINESTRING
-    m = re.search(r"LINESTRING\s*\((.*)\)", s, flags=re.I | re.S)
-    if m:
-        inner = m.group(1)
-        pts = []
-        for pair in inner.split(","):
-            parts = pair.strip().split()
-            if len(parts) >= 2:
-                try:
-                    lon = float(parts[0]); lat = float(parts[1])
-                    pts.append((lon, lat))
-                except Exception:
-                    continue
+        return mean_point([(lon, lat) for line in geom for lon, lat in line])
+    except (ValueError, TypeError):     # malformed JSON / unexpected nesting or values
+        return ""
+
+def wkt_pairs(inner: str) -> list:
+    """
+    'lon lat, lon lat, ...' -> [(lon, lat), ...]. Plain 2D lists are converted straight from
+    the token list; anything else (Z values, empty or bad pairs) goes through the per-pair loop.
+    """
+    tokens = inner.replace(",", " , ").split()
+    seps = tokens[2::3]
+    if len(tokens) % 3 == 2 and tokens.count(",") == len(seps) == seps.count(","):
+        try:
+            return list(zip(map(float, tokens[0::3]), map(float, tokens[1::3])))
+        except ValueError:
+            pass
+    pts = []
+    for pair in inner.split(","):
+        parts = pair.strip().split()
+        if len(parts) >= 2:
+            try:
+                lon = float(parts[0]); lat = float(parts[1])
+                pts.append((lon, lat))
+            except ValueError:
+                continue
+    return pts
+
+def wkt_body(head_re, s: str, close: str):
+    """
+    Text between the first `head_re` match and the last `close` after it, or None.
+    Same result as a greedy '(.*)' capture, but found with rfind so it stays linear on huge geometries.
+    """
+    m = head_re.search(s)
+    if not m:
+        return None
+    end = s.rfind(close)
+    return s[m.end():end] if end >= m.end() else None
+
+def wkt_points(s: str) -> list:
+    """Points of a WKT MULTILINESTRING(...) or, failing that, LINESTRING(...)."""
+    inner = wkt_body(MLS_HEAD_RE, s, "))") if "MULTILINESTRING" in s.upper() else None
+    if inner is not None:
+        pts = wkt_pairs(SEG_SPLIT_RE.sub(",", inner))
         if pts:
-            lon_mean = sum(p[0] for p in pts) / len(pts)
-            lat_mean = sum(p[1] for p in pts) / len(pts)
-            return f"@{lat_mean}/{lon_mean}"
+            return pts
+    inner = wkt_body(LS_HEAD_RE, s, ")")
+    return wkt_pairs(inner) if inner is not None else []
 
-    return ""
+def coords_from_any(values: pd.Series) -> pd.Series:
+    """
+    Return '@lat/lon' for QS P625, for a whole column.
+    Accepts JSON [[[lon,lat],...], ...], WKT MULTILINESTRING(...), or WKT LINESTRING(...).
+    A prefix test routes each row to a single parser instead of trying all three in turn.
+    """
+    s = values.str.strip().str.strip("'").str.strip('"')
+    out = pd.Series("", index=values.index, dtype=object)
+
+    is_json = s.str.lstrip().str.startswith("[")
+    out[is_json] = s[is_json].map(json_centroid)
 
-def build_row(rec: dict) -> list:
+    is_wkt = (out == "") & s.str.contains("LINESTRING", case=False, regex=False)
+    out[is_wkt] = s[is_wkt].map(lambda v: mean_point(wkt_points(v)))
+    return out
+
+def build_columns(rec: dict) -> list:
+    """Lay out the QS columns; values are whole Series (or constants broadcast to every row)."""
     out = []
     out += [rec["qid"], rec["Len"], rec["Les"], rec["Den"], rec["Des"]]
-    out += [Q_OVERHEAD_LINE, S248_QID, S854_URL, S813_TIME]    # P31 + refs
-    out += [COUNTRY_QID,   S248_QID, S854_URL, S813_TIME]      # P17 + refs
-    out += [rec["P625"],   S248_QID, S854_URL, S813_TIME]      # P625 + refs
-    out += [f'"{rec["P528"]}"', S248_QID, S854_URL, S813_TIME] # P528 + refs
-    out += [rec["P2436"],  S248_QID, S854_URL, S813_TIME]      # P2436 + refs
-    out += [f'+{rec["P2043"]}{U_METRE}' if rec["P2043"] else "", S248_QID, S854_URL, S813_TIME]  # P2043 + refs
+    out += [Q_OVERHEAD_LINE, *REF]           # P31 + refs
+    out += [COUNTRY_QID,     *REF]           # P17 + refs
+    out += [rec["P625"],     *REF]           # P625 + refs
+    out += ['"' + rec["P528"] + '"', *REF]   # P528 + refs
+    out += [rec["P2436"],    *REF]           # P2436 + refs
+    p2043 = rec["P2043"]
+    out += [("+" + p2043 + U_METRE).where(p2043 != "", ""), *REF]  # P2043 + refs
     return out
 
-def main():
-    df = pd.read_csv(
-        INPUT_CSV,
+def read_input_csv(path: str) -> pd.DataFrame:
+    """Read every column as text, empty cells as ''; pyarrow when installed, pandas otherwise."""
+    if pv is not None:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            names = next(csv.reader(f), [])
+        try:
+            table = pv.read_csv(
+                path,
+                parse_options=pv.ParseOptions(quote_char='"', double_quote=True, escape_char="\\"),
+                convert_options=pv.ConvertOptions(
+                    column_types={c: pa.string() for c in names},
+                    strings_can_be_null=False,
+                ),
+            )
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            pass
+    read_kwargs = dict(
         encoding="utf-8-sig",           # handles BOM safely
         sep=",",
         quotechar='"',
         doublequote=True,
         escapechar="\\",
-        engine="python",
         dtype=str,
         keep_default_na=False,
+        na_filter=False,                # everything is text; skip NaN detection entirely
     )
+    try:
+        return pd.read_csv(path, **read_kwargs)
+    except pd.errors.ParserError:
+        # the C parser is strict about malformed rows; the python engine is slower but lenient
+        return pd.read_csv(path, engine="python", **read_kwargs)
 
-    rows = []
-    for _, r in df.iterrows():
-        qid = r.get(COL_QID)
-        qid_cell = qid if (isinstance(qid, str) and str(qid).startswith("Q")) else ""
-
-        code  = (r.get(COL_CODE) or "").strip()
-        tramo = (r.get(COL_TRAMO) or "").strip()
+def main():
+    df = read_input_csv(INPUT_CSV)
 
-        coords_json = (r.get(COL_COORDSJ) or "").strip()
-        coords = coord_from_any(coords_json)
+    qid = column(df, COL_QID)
+    qid_cell = qid.where(qid.str.startswith("Q"), "")
 
-        token = ext_token(str(r.get(COL_FID, "")), coords_json)
+    code  = column(df, COL_CODE).str.strip()
+    tramo = column(df, COL_TRAMO).str.strip()
 
-        voltage_str = volts_from_kv(r.get(COL_VOLTAGE))
-        length_str  = plain_decimal(r.get(COL_LENGTH))
+    coords_json = column(df, COL_COORDSJ).str.strip()
+    coords = coords_from_any(coords_json)
 
-        label = code or "Linea/circuito del SIN"
-        desc_text_es = (tramo or "Linea/circuito del SIN de país") + f" [EXT:{token}]"
-        desc_text_en = desc_text_es
+    fids = column(df, COL_FID).to_numpy()
+    tokens = pd.Series(
+        [ext_token(str(fid), cj) for fid, cj in zip(fids, coords_json.to_numpy())],
+        index=df.index, dtype=tramo.dtype,  # match the text columns so 0-row inputs still concatenate
+    )
 
-        rec = {
-            "qid": qid_cell,
-            "Len": label,
-            "Les": label,
-            "Den": desc_text_en,
-            "Des": desc_text_es,
-            "P625": coords,
-            "P528": label,
-            "P2436": voltage_str,
-            "P2043": length_str,
-        }
-        rows.append(build_row(rec))
+    voltage_str = volts_from_kv(column(df, COL_VOLTAGE))
+    length_str  = plain_decimal(column(df, COL_LENGTH))
+
+    label = code.where(code != "", "Linea/circuito del SIN")
+    desc_text_es = tramo.where(tramo != "", "Linea/circuito del SIN de país") + " [EXT:" + tokens + "]"
+    desc_text_en = desc_text_es
+
+    rec = {
+        "qid": qid_cell,
+        "Len": label,
+        "Les": label,
+        "Den": desc_text_en,
+        "Des": desc_text_es,
+        "P625": coords,
+        "P528": label,
+        "P2436": voltage_str,
+        "P2043": length_str,
+    }
 
     header = [
         "qid","Len","Les","Den","Des",
@@ -243,8 +295,15 @@ def main():
         "P2043","S248","s854","s813",
     ]
 
-    pd.DataFrame(rows, columns=header).to_csv(QS_OUT, index=False, encoding="utf-8-sig")
-    print(f"[OK] File created: {QS_OUT} ({len(rows)} rows)")
+    columns = [
+        c.to_numpy() if isinstance(c, pd.Series) else itertools.repeat(c, len(df))
+        for c in build_columns(rec)
+    ]
+    with open(QS_OUT, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(header)
+        writer.writerows(zip(*columns))
+    print(f"[OK] File created: {QS_OUT} ({len(df)} rows)")
 
 if __name__ == "__main__":
     main()
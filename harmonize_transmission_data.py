@@ -7,17 +7,27 @@ country,qid,Codigo,TRAMO,Un,Long,_feature_id,_coords_json
 """
 import csv
 import hashlib
-import io
 import json
+import os
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from tempfile import SpooledTemporaryFile
+from typing import Dict, List, Optional
 
 import pandas as pd
 import yaml
 
 TARGET_COLUMNS = ['country','qid','Codigo','TRAMO','Un','Long','_feature_id','_coords_json']
+REPAIR_SPOOL_BYTES = 64 * 1024 * 1024
+
+# ---------------- Regex patterns (compiled once) ----------------
+DECIMAL_RE = re.compile(r'([-+]?\d+(?:\.\d+)?)')
+KV_RE = re.compile(r'(\d+(?:\.\d+)?)\s*kV', re.I)
+MLS_HEAD_RE = re.compile(r'MULTILINESTRING\s*\(\(', re.I)
+SEG_SPLIT_RE = re.compile(r'\)\s*,\s*\(')
 
 # ---------------- YAML helpers ----------------
 def read_yaml(path: Path) -> dict:
@@ -33,53 +43,76 @@ def load_csv_safely(path: Path) -> pd.DataFrame:
     Robust CSV reader that also repairs rows exported as a single giant quoted cell.
     Ensures UTF-8 handling and preserves commas correctly.
     """
-    raw = path.read_text(encoding='utf-8', errors='replace')
-    lines = raw.splitlines()
-    if not lines:
-        return pd.DataFrame()
-
-    header = lines[0]
-    repaired = [header.lstrip('\ufeff')]
-    for line in lines[1:]:
-        L = line.strip()
-        # Repair case: entire row is quoted and uses doubled quotes for inner quotes
-        if len(L) >= 2 and L[0] == '"' and L[-1] == '"' and '""' in L:
-            inner = L[1:-1].replace('""','"')
-            repaired.append(inner)
-        else:
-            repaired.append(line)
-
-    try:
-        df = pd.read_csv(io.StringIO('\n'.join(repaired)), encoding='utf-8')
-    except Exception:
-        # Fallback to utf-8-sig if BOM present
-        df = pd.read_csv(path, encoding='utf-8-sig')
+    # Repair line by line into a spooled buffer (in memory up to REPAIR_SPOOL_BYTES, then on disk)
+    # instead of holding the raw text, its lines and the repaired copy all at once.
+    with open(path, 'r', encoding='utf-8', errors='replace') as fin, \
+            SpooledTemporaryFile(mode='w+', max_size=REPAIR_SPOOL_BYTES, encoding='utf-8') as tmp:
+        header = fin.readline()
+        if not header:
+            return pd.DataFrame()
+        tmp.write(header.lstrip('\ufeff'))
+        for line in fin:
+            L = line.strip()
+            # Repair case: entire row is quoted and uses doubled quotes for inner quotes
+            if len(L) >= 2 and L[0] == '"' and L[-1] == '"' and '""' in L:
+                tmp.write(L[1:-1].replace('""','"') + '\n')
+            else:
+                tmp.write(line)
+        tmp.seek(0)
+
+        try:
+            df = pd.read_csv(tmp)
+        except Exception:
+            # Fallback to utf-8-sig if BOM present
+            df = pd.read_csv(path, encoding='utf-8-sig')
 
     df.columns = [strip_bom(c) for c in df.columns]
     return df
 
 # ---------------- Value transforms ----------------
-def to_number_str(val: Any) -> Optional[float]:
-    if val is None:
-        return None
-    if isinstance(val,(int,float)):
-        return float(val)
-    s = str(val).strip()
-    if not s:
-        return None
-    s = s.replace(',', '.')
-    m = re.search(r'[-+]?\d+(?:\.\d+)?', s)
-    return float(m.group(0)) if m else None
+def to_number_str(values: pd.Series) -> pd.Series:
+    """
+    Column-wise number parsing. Numeric cells pass through as float; text cells yield
+    their first number, or NaN when none is found (see `unparsed` for telling the two apart).
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype(float)
+    nums = values.str.strip().str.replace(',', '.', regex=False).str.extract(DECIMAL_RE, expand=False)
+    return nums.astype(float)
 
-def km_to_m(val: Any) -> Optional[float]:
-    num = to_number_str(val)
-    return num*1000.0 if num is not None else None
+def unparsed(values: pd.Series, nums: pd.Series) -> pd.Series:
+    """Cells that held a value but yielded no number (missing cells stay NaN, not 'unparsed')."""
+    return nums.isna() & values.notna()
 
-def extract_kv_from_text(s: str) -> Optional[float]:
-    if not isinstance(s,str):
-        return None
-    m = re.search(r'(\d+(?:\.\d+)?)\s*kV', s, flags=re.I)
-    return float(m.group(1)) if m else None
+def km_to_m(values: pd.Series) -> pd.Series:
+    return to_number_str(values) * 1000.0
+
+def extract_kv_from_text(values: pd.Series) -> pd.Series:
+    kv = values.astype(object).map(str).str.extract(KV_RE, expand=False)
+    return kv.astype(float)
+
+def wkt_pairs(seg: str) -> List[List[float]]:
+    """
+    'lon lat, lon lat, ...' -> [[lon, lat], ...]. Plain 2D segments are converted straight
+    from the token list; anything else (Z values, empty pairs) goes through the per-pair loop.
+    """
+    tokens = seg.replace(',', ' , ').split()
+    seps = tokens[2::3]
+    if len(tokens) % 3 == 2 and tokens.count(',') == len(seps) == seps.count(','):
+        try:
+            return [[lon, lat] for lon, lat in zip(map(float, tokens[0::3]), map(float, tokens[1::3]))]
+        except ValueError:
+            pass
+    pts = []
+    for pair in seg.split(','):
+        pair = pair.strip()
+        if not pair:
+            continue
+        parts = pair.split()
+        if len(parts) >= 2:
+            lon = float(parts[0]); lat = float(parts[1])
+            pts.append([lon, lat])
+    return pts
 
 def to_coords_json_from_wkt_multilinestring(wkt: str) -> Optional[str]:
     if not isinstance(wkt,str) or not wkt.strip():
@@ -89,22 +122,17 @@ def to_coords_json_from_wkt_multilinestring(wkt: str) -> Optional[str]:
         text = text[1:]
     if text.endswith("'") or text.endswith('"'):
         text = text[:-1]
-    m = re.search(r'MULTILINESTRING\s*\(\((.*)\)\)\s*$', text, flags=re.I|re.S)
-    if not m:
+    # body runs from 'MULTILINESTRING((' to the closing '))' at the very end; sliced rather than
+    # captured with a greedy regex so parse time stays linear in the geometry size
+    m = MLS_HEAD_RE.search(text)
+    body = text.rstrip()
+    if not m or not body.endswith('))') or len(body) - 2 < m.end():
         return None
-    inner = m.group(1)
-    segments = re.split(r'\)\s*,\s*\(', inner)
+    inner = body[m.end():-2]
+    segments = SEG_SPLIT_RE.split(inner)
     multilines = []
     for seg in segments:
-        pts = []
-        for pair in seg.split(','):
-            pair = pair.strip()
-            if not pair:
-                continue
-            parts = pair.split()
-            if len(parts) >= 2:
-                lon = float(parts[0]); lat = float(parts[1])
-                pts.append([lon, lat])
+        pts = wkt_pairs(seg)
         if pts:
             multilines.append(pts)
     return json.dumps(multilines, ensure_ascii=False)
@@ -133,60 +161,77 @@ def derive_mapping(df: pd.DataFrame, profile_cols: dict, override_cols: dict) ->
         mapping[target_col] = {'_col': found, '_transform': transform, '_candidates': candidates}
     return mapping
 
-# ---------------- Row build ----------------
-def build_output_row(row: dict, mapping: dict, country_value: str) -> dict:
-    qid = str(row.get(mapping['qid']['_col'], '')).strip() if mapping['qid'].get('_col') else ''
-    codigo = str(row.get(mapping['Codigo']['_col'], '')).strip()
-    tramo = str(row.get(mapping['TRAMO']['_col'], '')).strip()
-
-    un_val = None
-    if mapping['Un'].get('_col'):
-        un_val = to_number_str(row.get(mapping['Un']['_col']))
-    if un_val is None and 'nivel_tension_circuito' in row:
-        un_val = extract_kv_from_text(str(row.get('nivel_tension_circuito')))
-
-    long_val = None
-    if mapping['Long'].get('_col'):
+# ---------------- Frame build ----------------
+def text_values(df: pd.DataFrame, col: Optional[str]) -> pd.Series:
+    """str() of every cell in `col` (missing cells read 'nan'), or '' when the column is unmapped."""
+    if not col:
+        return pd.Series('', index=df.index, dtype=object)
+    return df[col].astype(object).map(str)
+
+def strip_wkt_quotes(values: pd.Series) -> pd.Series:
+    g = values.str.strip()
+    g = g.where(~g.str.startswith("'"), g.str[1:])
+    return g.where(~(g.str.endswith("'") | g.str.endswith('"')), g.str[:-1])
+
+def build_output_frame(df: pd.DataFrame, mapping: dict, country_value: str) -> pd.DataFrame:
+    no_value = pd.Series(True, index=df.index)
+
+    qid = text_values(df, mapping['qid'].get('_col')).str.strip()
+    codigo = text_values(df, mapping['Codigo'].get('_col')).str.strip()
+    tramo = text_values(df, mapping['TRAMO'].get('_col')).str.strip()
+
+    un_col = mapping['Un'].get('_col')
+    if un_col:
+        un_val = to_number_str(df[un_col])
+        un_missing = unparsed(df[un_col], un_val)
+    else:
+        un_val, un_missing = pd.Series(float('nan'), index=df.index), no_value
+    if 'nivel_tension_circuito' in df.columns:
+        kv = extract_kv_from_text(df['nivel_tension_circuito'])
+        un_val = un_val.where(~un_missing, kv)
+        un_missing = un_missing & kv.isna()
+
+    long_col = mapping['Long'].get('_col')
+    if long_col:
         if mapping['Long'].get('_transform') == 'km_to_m':
-            long_val = km_to_m(row.get(mapping['Long']['_col']))
-        else:
-            long_val = to_number_str(row.get(mapping['Long']['_col']))
-    if long_val is None and 'Shape__Length' in row:
-        long_val = to_number_str(row.get('Shape__Length'))
-
-    coords_json = None
-    if mapping['_coords_json'].get('_col'):
-        if mapping['_coords_json'].get('_transform') == 'to_coords_json':
-            raw_geom = str(row.get(mapping['_coords_json']['_col']))
-            coords_json = to_coords_json_from_wkt_multilinestring(raw_geom)
-            if coords_json is None:
-                # fallback: keep raw text if parser fails (e.g., truncated WKT)
-                g = (raw_geom or '').strip()
-                if g.startswith("'"):
-                    g = g[1:]
-                if g.endswith("'") or g.endswith('"'):
-                    g = g[:-1]
-                coords_json = g
+            long_val = km_to_m(df[long_col])
         else:
-            coords_json = str(row.get(mapping['_coords_json']['_col']) or '').strip() or None
+            long_val = to_number_str(df[long_col])
+        long_missing = unparsed(df[long_col], long_val)
+    else:
+        long_val, long_missing = pd.Series(float('nan'), index=df.index), no_value
+    if 'Shape__Length' in df.columns:
+        shape_len = to_number_str(df['Shape__Length'])
+        long_val = long_val.where(~long_missing, shape_len)
+        long_missing = long_missing & unparsed(df['Shape__Length'], shape_len)
+
+    coords_col = mapping['_coords_json'].get('_col')
+    if coords_col and mapping['_coords_json'].get('_transform') == 'to_coords_json':
+        raw_geom = text_values(df, coords_col)
+        coords_json = raw_geom.map(to_coords_json_from_wkt_multilinestring)
+        # fallback: keep raw text if parser fails (e.g., truncated WKT)
+        coords_json = coords_json.where(coords_json.notna(), strip_wkt_quotes(raw_geom))
+    elif coords_col:
+        coords_json = df[coords_col].astype(object).map(lambda v: str(v or '')).str.strip()
+    else:
+        coords_json = pd.Series('', index=df.index, dtype=object)
 
-    # stable feature id based on key fields
-    h = hashlib.sha1()
-    h.update((codigo or '').encode('utf-8'))
-    h.update(str(long_val or '').encode('utf-8'))
-    h.update((coords_json or '').encode('utf-8'))
-    feature_id = h.hexdigest()[:12]
+    # stable feature id based on key fields (`str(long_val or '')` per row: NaN hashes as 'nan').
+    # Fields are concatenated without a separator, exactly as the former per-field sha1.update calls.
+    long_text = long_val.map(str).where(~long_missing & (long_val != 0), '')
+    basis = (codigo + long_text + coords_json).str.encode('utf-8')
+    feature_id = [hashlib.sha1(b).hexdigest()[:12] for b in basis]
 
-    return {
+    return pd.DataFrame({
         'country': country_value or '',
-        'qid': qid or '',
+        'qid': qid,
         'Codigo': codigo,
         'TRAMO': tramo,
-        'Un': un_val if un_val is not None else '',
-        'Long': long_val if long_val is not None else '',
+        'Un': un_val.astype(object).where(~un_missing, ''),
+        'Long': long_val.astype(object).where(~long_missing, ''),
         '_feature_id': feature_id,
-        '_coords_json': coords_json or ''
-    }
+        '_coords_json': coords_json,
+    }, index=df.index, columns=TARGET_COLUMNS)
 
 # ---------------- Runner ----------------
 def run_profile(input_path: Path, profiles: dict, inp_block: dict) -> Path:
@@ -212,14 +257,8 @@ def run_profile(input_path: Path, profiles: dict, inp_block: dict) -> Path:
     # Country may be missing; leave blank if not provided
     country_value = ((inp_block or {}).get('country') or {}).get('label') or ''
 
-    records = []
-    for _, r in df.iterrows():
-        row_dict = {strip_bom(k): r[k] for k in df.columns}
-        rec = build_output_row(row_dict, mapping, country_value)
-        if rec['Codigo']:
-            records.append(rec)
-
-    out_df = pd.DataFrame(records, columns=TARGET_COLUMNS)
+    out_df = build_output_frame(df, mapping, country_value)
+    out_df = out_df[out_df['Codigo'] != '']
     out_path = input_path.with_name(input_path.stem + '_harmonized_for_qs.csv')
     out_df.to_csv(out_path, index=False, encoding='utf-8-sig', quoting=csv.QUOTE_MINIMAL)
     print(f"[INFO] Wrote {len(out_df)} rows -> {out_path}")
@@ -239,6 +278,7 @@ def main():
         print('[WARN] No inputs configured.')
         return
 
+    jobs = []
     for inp in inputs:
         path = Path(inp.get('path',''))
         if not path.is_absolute():
@@ -246,8 +286,18 @@ def main():
         if not path.exists():
             print(f'[WARN] Missing file: {path} — skipping')
             continue
+        jobs.append((path, inp))
+
+    if len(jobs) <= 1:
+        for path, inp in jobs:
+            run_profile(path, profiles, inp)
+        return
 
-        run_profile(path, profiles, inp)
+    # each input is independent and CPU-bound: harmonize them in parallel processes
+    workers = min(len(jobs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        paths, inps = zip(*jobs)
+        list(pool.map(run_profile, paths, repeat(profiles), inps))
 
 if __name__ == '__main__':
     main()